@@ -6,17 +6,35 @@ Updated 07 May 2025
   • Layout mais compacto, alinhamento lateral do botão e texto
 """
 
-import os, pickle, numpy as np, pandas as pd
+import io, os, numpy as np, pandas as pd
 import streamlit as st
 import plotly.graph_objects as go
+import plotly.io as pio
 from streamlit_plotly_events import plotly_events
+from PIL import Image
+
+# Serialização das figuras em C (orjson, ver requirements.txt)
+pio.json.config.default_engine = "orjson"
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Page config & CSS
 # ──────────────────────────────────────────────────────────────────────────────
 st.set_page_config(layout="wide")
-st.markdown(
-    """
+
+# Configuração – único ponto para ajustar proporções, alturas e opções padrão
+CONFIG = dict(
+    col_ratio=[1, 0.9], chart_height=400, events_height=450,
+    map_width=600,   # largura de exibição do mapa (px)
+    default_mass="Açude Castanhão",
+    agg_opts=[
+        "Diário", "Mensal", "Trimestral", "Anual",
+        "Permanência", "Estado Trófico", "Estado Trófico Mensal",
+    ],
+)
+
+# CSS estático (sem interpolação). Reenviado a cada rerun de propósito: elementos
+# não emitidos num rerun são removidos pelo Streamlit, junto com o <style>.
+CSS = """
 <style>
 /* ——— Título ——— */
 .smaller-title{
@@ -48,9 +66,8 @@ div[data-testid="stRadio"] div[role="radiogroup"]{
     row-gap:4px;
 }
 </style>
-""",
-    unsafe_allow_html=True,
-)
+"""
+st.markdown(CSS, unsafe_allow_html=True)
 st.markdown(
     '<p class="smaller-title">Visualização de qualidade de Água obtida por dados espaciais</p>',
     unsafe_allow_html=True,
@@ -59,203 +76,359 @@ st.markdown(
 # ──────────────────────────────────────────────────────────────────────────────
 # Helpers
 # ──────────────────────────────────────────────────────────────────────────────
-@st.cache_data
-def load_data(fp: str) -> pd.DataFrame:
-    with open(fp, "rb") as f:
-        return pickle.load(f)
+DATA_COLS = [
+    "nmoriginal", "date_key", "gid",
+    "chla_mean", "chla_media", "chla_count",
+    "turb_mean", "turb_media", "turb_count",
+]
 
-def resolve_stat_col(df: pd.DataFrame, base_param: str, stat: str) -> str:
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_data(fp: str):
+    """Retorna (df, {massa: slice}, COL_MAP) com df ordenado por massa e data.
+
+    Objeto compartilhado (sem cópia por rerun): tratar como somente leitura.
+    """
+    # Parquet gerado por pkl_to_parquet.py – date_key já vem como datetime64
+    df = pd.read_parquet(fp, columns=DATA_COLS)
+    if df["date_key"].dtype.kind != "M":
+        df["date_key"] = pd.to_datetime(df["date_key"], errors="coerce")
+    # linhas sem data nunca são plotadas – descartadas aqui, uma única vez
+    df = df.dropna(subset=["date_key"])
+    df["nmoriginal"] = df["nmoriginal"].astype("category")
+    df["gid"] = df["gid"].astype("int32")
+    df[["chla_count", "turb_count"]] = df[["chla_count", "turb_count"]].astype("int32")
+    # Valores gravados × 100 – escala aplicada uma única vez, já em µg/L e NTU
+    for c in ("chla_mean", "chla_media", "turb_mean", "turb_media"):
+        df[c] = df[c].astype("float32") / np.float32(100)
+
+    df.sort_values(["nmoriginal", "date_key"], inplace=True, ignore_index=True)
+    codes  = df["nmoriginal"].cat.codes.values
+    starts = np.r_[0, np.flatnonzero(np.diff(codes)) + 1, len(codes)]
+    mass_slices = {
+        df["nmoriginal"].cat.categories[codes[a]]: slice(a, b)
+        for a, b in zip(starts[:-1], starts[1:])
+        if codes[a] >= 0
+    }
+    return df, mass_slices, build_col_map(df.columns)
+
+# Sufixos aceitos por estatística, em ordem de preferência
+STAT_SUFFIXES = {"mean": ("_mean",), "median": ("_media", "_median"), "count": ("_count",)}
+
+def build_col_map(columns) -> dict:
+    """{(prefixo, estatística): coluna} – montado em load_data, junto com o frame em cache."""
+    cols = set(columns)
+    return {
+        (pref, stat): next((pref + s for s in sufs if pref + s in cols), pref + sufs[0])
+        for pref in ("chla", "turb")
+        for stat, sufs in STAT_SUFFIXES.items()
+    }
+
+def resolve_stat_col(base_param: str, stat: str) -> str:
     pref = "chla" if base_param.startswith("chla") else "turb"
-    if   stat == "mean":   cands = [f"{pref}_mean"]
-    elif stat == "median": cands = [f"{pref}_media", f"{pref}_median"]
-    elif stat == "count":  cands = [f"{pref}_count"]
-    else:                  cands = [f"{pref}_{stat}"]
-    return next((c for c in cands if c in df.columns), cands[0])
+    return COL_MAP.get((pref, stat), f"{pref}_{stat}")
 
-def values(df: pd.DataFrame, col: str):
-    return (df[col].astype(float) / 100).tolist()
+def values(df: pd.DataFrame, col: str) -> np.ndarray:
+    # ndarray para o trabalho em Python; o trace recebe to_trace(values(...))
+    return df[col].to_numpy()
+
+def to_trace(a: np.ndarray) -> list:
+    """ndarray → list na fronteira do trace.
+
+    Plotly ≥ 6 serializa ndarrays numéricos como {"dtype", "bdata"}, que o plotly.js 1.58
+    do streamlit-plotly-events não decodifica (trace vazio).
+    """
+    if a.dtype.kind == "f":
+        a = np.round(a.astype("float64"), 4)   # float32 → sem ruído de representação no JSON
+    return a.tolist()
+
+def q1(a: np.ndarray) -> float:
+    """1º quartil com interpolação linear (= Series.quantile(0.25)), via np.partition – O(N)."""
+    pos = 0.25 * (a.size - 1)
+    k   = int(pos)
+    j   = min(k + 1, a.size - 1)
+    lo, hi = np.partition(a, [k, j])[[k, j]]
+    return float(lo + (hi - lo) * (pos - k))
+
+def rolling_mean(t: np.ndarray, y: np.ndarray, days: int) -> np.ndarray:
+    """Média móvel centrada de `days` dias sobre datas ordenadas (NaN ignorados).
+
+    Mesma janela de pandas rolling(f"{days}D", center=True, min_periods=1):
+    (t − days/2, t + days/2], via searchsorted + somas acumuladas – O(N log N).
+    """
+    half = np.timedelta64(days * 12, "h")
+    lo   = np.searchsorted(t, t - half, side="right")
+    hi   = np.searchsorted(t, t + half, side="right")
+    ok   = np.isfinite(y)
+    csum = np.r_[0.0, np.cumsum(np.where(ok, y, 0), dtype="float64")]
+    ccnt = np.r_[0, np.cumsum(ok)]
+    cnt  = ccnt[hi] - ccnt[lo]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (csum[hi] - csum[lo]) / cnt
+
+def epoch_ms(t: np.ndarray) -> np.ndarray:
+    """datetime64 → ms desde a época (int64): 13 dígitos por ponto no JSON, em vez de uma data ISO."""
+    return t.astype("datetime64[ms]").astype("int64")
+
+def lttb_idx(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Índices dos pontos mantidos pelo Largest-Triangle-Three-Buckets.
+
+    Preserva 1º e último ponto e o de maior área em cada balde – picos não somem.
+    """
+    n = len(x)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    x     = x.astype("float64")
+    y     = np.nan_to_num(y.astype("float64"))
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep  = np.empty(n_out, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        b0, b1 = edges[i], edges[i + 1]
+        c0, c1 = b1, edges[i + 2] if i + 2 < len(edges) else n
+        cx, cy = x[c0:c1].mean(), y[c0:c1].mean()
+        area   = np.abs((x[a] - cx) * (y[b0:b1] - y[a]) - (x[a] - x[b0:b1]) * (cy - y[a]))
+        a = keep[i + 1] = b0 + int(np.argmax(area))
+    return keep
+
+@st.cache_resource(ttl=3600, show_spinner=False)
+def build_map_index(root: str, mtime: float):
+    """Varre `root` uma única vez com os.scandir.
+
+    Retorna (caminhos, meses): o conjunto de todos os PNGs existentes e
+    {(pasta, "AAAA_MM"): caminho} com o 1º arquivo de cada mês por pasta.
+    """
+    paths, months, stack = set(), {}, [root]
+    while stack:
+        folder = stack.pop()
+        try:
+            entries = sorted(os.scandir(folder), key=lambda e: e.name)
+        except OSError:
+            continue
+        for e in entries:
+            if e.is_dir():
+                stack.append(e.path)
+            elif e.name.lower().endswith(".png"):
+                paths.add(e.path)
+                months.setdefault((folder, e.name[:7]), e.path)
+    return paths, months
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def read_png(path: str, mtime: float, width: int = 2 * CONFIG["map_width"]) -> bytes:
+    """Bytes do mapa reduzido a `width` px de largura (2× a de exibição: nítido em telas high-DPI)."""
+    # `mtime` só entra na chave do cache: PNG regravado → nova leitura
+    with open(path, "rb") as f:
+        raw = f.read()
+    with Image.open(io.BytesIO(raw)) as im:
+        if im.width <= width:
+            return raw
+        im.thumbnail((width, im.height), Image.LANCZOS)
+        buf = io.BytesIO()
+        im.save(buf, "PNG", optimize=True)
+    return buf.getvalue()
+
+class FigJSON:
+    """Figura pré-serializada: plotly_events só precisa de `.to_json()`."""
+    __slots__ = ("js",)
+    def __init__(self, js: str):
+        self.js = js
+    def to_json(self) -> str:
+        return self.js
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Paths & data
 # ──────────────────────────────────────────────────────────────────────────────
 BASE_DIR    = os.path.dirname(__file__)
-PKL_PATH    = os.path.join(BASE_DIR, "all_water_masses.pkl")
+DATA_PATH   = os.path.join(BASE_DIR, "all_water_masses.parquet")
 MAPS_FOLDER = os.path.join(BASE_DIR, "maps")
 
-gdf = load_data(PKL_PATH)
-gdf["date_key"] = pd.to_datetime(gdf["date_key"], errors="coerce")
-
-# ──────────────────────────────────────────────────────────────────────────────
-# Layout
-# ──────────────────────────────────────────────────────────────────────────────
-left, right = st.columns([1, 0.9], gap="small")
-
-with left:
-    # 1) Massa d’água
-    masses   = sorted(gdf["nmoriginal"].dropna().unique())
-    default  = "Açude Castanhão" if "Açude Castanhão" in masses else masses[0]
-    sel_mass = st.selectbox("Selecione a massa d'água:", masses, index=masses.index(default))
-
-    # 2) Parâmetro
-    param_opts = {"Clorofila-a": "chla_mean", "Turbidez": "turb_mean"}
-    param_lab  = st.radio("Selecione o parâmetro:", list(param_opts.keys()))
-    param_col  = param_opts[param_lab]
-
-    # 3) Estatística
-    stat_opts = {"Média": "mean", "Mediana": "median"}
-    stat_lab  = st.radio("Estatística mostrada no gráfico:", list(stat_opts.keys()), horizontal=True)
-    stat_key  = stat_opts[stat_lab]
-
-    # 4) Intervalo de datas
-    dmin, dmax = gdf["date_key"].min().date(), gdf["date_key"].max().date()
-    d_range = st.slider("Selecione o intervalo de datas:", dmin, dmax, (dmin, dmax), format="YYYY-MM-DD")
-
-    # 5) Nível de agregação (mapas)
-    agg_opts = [
-        "Diário", "Mensal", "Trimestral", "Anual",
-        "Permanência", "Estado Trófico", "Estado Trófico Mensal"
-    ]
-    agg_sel  = st.radio("Selecione o nível de agregação do mapa:", agg_opts, horizontal=True)
+# (agregação, parâmetro) → (subpastas sob maps/<gid>, nome do arquivo).
+# fmt None = pasta mensal, resolvida pelo 1º arquivo do mês; sem entrada = sem mapa.
+MAP_DISPATCH = {
+    ("Diário", "chla_mean"):      (("Chla", "Diário"), "{dstr}_Chla_Diario.png"),
+    ("Diário", "turb_mean"):      (("Turbidez", "Diário"), "{dstr}_Turb_Diario.png"),
+    ("Mensal", "chla_mean"):      (("Chla", "Mensal", "Média"), None),
+    ("Mensal", "turb_mean"):      (("Turbidez", "Mensal", "Média"), None),
+    ("Trimestral", "chla_mean"):  (("Chla", "Trimestral", "Média"), "{year}_{q}°Trimestre_Média.png"),
+    ("Trimestral", "turb_mean"):  (("Turbidez", "Trimestral", "Média"), "{year}_{q}°Trimestre_Média.png"),
+    ("Anual", "chla_mean"):       (("Chla", "Anual", "Média"), "{year}_Média.png"),
+    ("Anual", "turb_mean"):       (("Turbidez", "Anual", "Média"), "{year}_Média.png"),
+    ("Permanência", "chla_mean"): (("Chla", "Anual", "Permanência_90"), "{year}_Permanência 90%.png"),
+    ("Permanência", "turb_mean"): (("Turbidez", "Anual", "Permanência_90"), "{year}_Permanência 90%.png"),
+    ("Estado Trófico", "chla_mean"):        (("Chla", "2018_2024", "Permanência_90"), "2018_2024_IET90.png"),
+    ("Estado Trófico Mensal", "chla_mean"): (("Chla", "Mensal", "Média", "IET"), "{month}_IET.png"),
+}
 
-    # ─── Filtra dados ─────────────────────────────────────────────────────────
-    df = gdf.loc[
-        (gdf["nmoriginal"] == sel_mass)
-        & (gdf["date_key"].dt.date >= d_range[0])
-        & (gdf["date_key"].dt.date <= d_range[1])
-    ].copy()
-    df = df[df[param_col] > 0]
-
-    # Filtro por contagem de pixels
-    cnt_col = resolve_stat_col(df, param_col, "count")
-    if cnt_col in df.columns:
-        if st.checkbox("Filtrar pontos com baixa contagem de pixels", value=False):
-            thr = max(5, df[cnt_col].quantile(0.25))
-            df = df[df[cnt_col] >= thr]
-            st.caption(f"Pontos com contagem &lt; **{int(thr)}** pixels removidos.")
+gdf, mass_slices, COL_MAP = load_data(DATA_PATH)
 
-    if df.empty:
-        st.warning("Nenhum dado disponível para essa combinação.")
-        st.stop()
+@st.cache_data(show_spinner=False)
+def get_controls():
+    """Massas, índice da massa padrão e limites globais de data – independem dos widgets.
 
-    df.sort_values("date_key", inplace=True, ignore_index=True)
+    Valem para o `gdf` do processo: um Parquet regravado só entra após limpar o cache.
+    """
+    # categorias já são os nomes únicos, ordenados e sem NaN
+    masses  = gdf["nmoriginal"].cat.categories.tolist()
+    def_idx = masses.index(CONFIG["default_mass"]) if CONFIG["default_mass"] in masses else 0
+    return masses, def_idx, gdf["date_key"].min().date(), gdf["date_key"].max().date()
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def get_mass_subset(mass: str, param_col: str) -> pd.DataFrame:
+    """Linhas da massa d'água com `param_col` > 0, ordenadas por data (todas as datas)."""
+    pref = "chla" if param_col.startswith("chla") else "turb"
+    cols = ["date_key", "gid"] + [c for c in gdf.columns if c.startswith(pref)]
+    sub  = gdf.iloc[mass_slices[mass]]
+    return sub.loc[sub[param_col].values > 0, cols].reset_index(drop=True)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def filter_df(mass: str, param_col: str, d0, d1, low_count: bool):
+    """Fatia [d0, d1] do subconjunto da massa, opcionalmente sem o 1º quartil de contagem.
+
+    Retorna (df, thr); thr é None quando o filtro de contagem não é aplicado.
+    """
+    # subconjunto já ordenado por data → o intervalo é uma fatia contígua
+    lo = np.datetime64(d0)
+    hi = np.datetime64(d1) + np.timedelta64(1, "D")
+    sub = get_mass_subset(mass, param_col)
+    i0, i1 = np.searchsorted(sub["date_key"].values, [lo, hi])
+    df  = sub.iloc[i0:i1]
+
+    thr = None
+    if low_count:
+        cnt_col = resolve_stat_col(param_col, "count")
+        cnt = df[cnt_col].to_numpy()
+        thr = max(5, q1(cnt)) if cnt.size else 5
+        df = df[cnt >= thr]
+    return df, thr
+
+# Layout fixo do gráfico; só título/faixa do eixo y variam por figura
+_BASE_LAYOUT = dict(
+    xaxis_title="Data",
+    xaxis=dict(type="date", showgrid=True),   # x em ms desde a época (ver epoch_ms)
+    margin=dict(l=40, r=20, t=20, b=50),
+    plot_bgcolor="white",
+    showlegend=False,
+    template="none",   # sem o template "plotly" embutido no JSON de cada figura
+    height=CONFIG["chart_height"],
+)
 
-    # ─── Série principal ─────────────────────────────────────────────────────
-    y_col  = resolve_stat_col(df, param_col, stat_key)
-    x_vals = df["date_key"].tolist()
+# Acima disso os marcadores são reduzidos por LTTB (payload e render do Plotly)
+MAX_POINTS = 2000
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def plot_rows(mass, param_col, stat_key, d0, d1, low_count) -> pd.DataFrame:
+    """Linhas efetivamente desenhadas como pontos; pointIndex do clique indexa este df."""
+    df, _ = filter_df(mass, param_col, d0, d1, low_count)
+    if len(df) <= MAX_POINTS:
+        return df
+    y_col = resolve_stat_col(param_col, stat_key)
+    keep  = lttb_idx(df["date_key"].values.view("int64"), values(df, y_col), MAX_POINTS)
+    return df.iloc[keep]
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def make_fig(mass, param_col, stat_key, d0, d1, low_count, show_roll) -> str:
+    """Figura da série já serializada (JSON) – independe do nível de agregação do mapa."""
+    df, _  = filter_df(mass, param_col, d0, d1, low_count)
+    pts    = plot_rows(mass, param_col, stat_key, d0, d1, low_count)
+    y_col  = resolve_stat_col(param_col, stat_key)
+    x_vals = df["date_key"].to_numpy()
     y_vals = values(df, y_col)
 
-    # ─── Média móvel – 30 dias ───────────────────────────────────────────────
-    show_roll = st.checkbox("Adicionar linha de média móvel (30 dias)", value=False)
-    if show_roll:
-        s_roll = (
-            pd.Series(y_vals, index=df["date_key"])
-            .rolling("30D", center=True, min_periods=1)
-            .mean()
-            .tolist()
-        )
-
-    # ─── Gráfico ─────────────────────────────────────────────────────────────
     color   = "limegreen" if param_col.startswith("chla") else "brown"
     y_title = "NTU" if param_col.startswith("turb") else "µg/L"
 
     fig = go.Figure()
 
-    # Pontos
+    # Pontos – WebGL (Scattergl): picking de clique igual, sem um nó SVG por ponto
     fig.add_trace(
-        go.Scatter(
-            x=x_vals, y=y_vals, mode="markers",
+        go.Scattergl(
+            x=to_trace(epoch_ms(pts["date_key"].to_numpy())), y=to_trace(values(pts, y_col)), mode="markers",
             marker=dict(size=8, color=color, line=dict(width=1, color="black")),
             name="", showlegend=False,
-            hovertemplate=f"<b>Data:</b> %{{x}}<br><b>Valor:</b> %{{y:.2f}} {y_title}<extra></extra>",
+            hovertemplate=f"<b>Data:</b> %{{x|%Y-%m-%d}}<br><b>Valor:</b> %{{y:.2f}} {y_title}<extra></extra>",
         )
     )
 
-    # Linha média móvel
+    # Linha média móvel – 30 dias
     if show_roll:
+        s_roll = rolling_mean(x_vals, y_vals, 30)
         fig.add_trace(
             go.Scatter(
-                x=x_vals, y=s_roll, mode="lines",
+                x=to_trace(epoch_ms(x_vals)), y=to_trace(s_roll), mode="lines",
                 line=dict(width=3, color="royalblue", shape="spline", smoothing=1.3),
                 name="", showlegend=False,
                 hovertemplate=f"Média móvel: %{{y:.2f}} {y_title}<extra></extra>",
             )
         )
 
+    y_max = float(np.nanmax(y_vals)) if y_vals.size else 1.0
+
     fig.update_layout(
-        xaxis_title="Data",
+        **_BASE_LAYOUT,
         yaxis_title=y_title,
-        yaxis=dict(range=[0, max(y_vals)*1.1], showgrid=True),
-        xaxis=dict(showgrid=True),
-        margin=dict(l=40, r=20, t=20, b=50),
-        plot_bgcolor="white",
-        showlegend=False,
-        height=400,
+        yaxis=dict(range=[0, y_max*1.1], showgrid=True),
+        # zoom/pan do usuário sobrevivem a reruns enquanto massa e parâmetro não mudam
+        uirevision=f"{mass}|{param_col}",
     )
+    return fig.to_json()
 
-    st.markdown('<div style="width:100%;">', unsafe_allow_html=True)
-    clicks = plotly_events(fig, click_event=True, hover_event=False, select_event=False, override_height=450)
-    st.markdown("</div>", unsafe_allow_html=True)
+masses, def_idx, dmin, dmax = get_controls()
+map_paths, map_months = build_map_index(
+    MAPS_FOLDER, os.path.getmtime(MAPS_FOLDER) if os.path.isdir(MAPS_FOLDER) else 0.0
+)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Right column – mapas
 # ──────────────────────────────────────────────────────────────────────────────
-with right:
-    def build_path(row):
-        gid, date = int(row["gid"]), row["date_key"]
-        base = "Chla" if param_col.startswith("chla") else "Turbidez"
-        dstr = date.strftime("%Y%m%d")
-
-        if agg_sel == "Diário":
-            name = f"{dstr}_{'Chla' if base=='Chla' else 'Turb'}_Diario.png"
-            return os.path.join(MAPS_FOLDER, str(gid), base, "Diário", name)
-
-        if agg_sel == "Mensal":
-            month = date.strftime("%Y_%m")
-            folder = os.path.join(MAPS_FOLDER, str(gid), base, "Mensal", "Média")
-            try:
-                img = next(f for f in os.listdir(folder) if f.startswith(month))
-                return os.path.join(folder, img)
-            except StopIteration:
-                return None
-
-        if agg_sel == "Estado Trófico Mensal":
-            if not param_col.startswith("chla"):
-                return None
-            month = date.strftime("%Y_%m")
-            return os.path.join(
-                MAPS_FOLDER, str(gid), "Chla", "Mensal", "Média", "IET", f"{month}_IET.png"
-            )
-
-        if agg_sel == "Trimestral":
-            q = (date.month - 1)//3 + 1
-            name = f"{date.year}_{q}°Trimestre_Média.png"
-            return os.path.join(MAPS_FOLDER, str(gid), base, "Trimestral", "Média", name)
-
-        if agg_sel == "Anual":
-            return os.path.join(MAPS_FOLDER, str(gid), base, "Anual", "Média", f"{date.year}_Média.png")
-
-        if agg_sel == "Estado Trófico":
-            if not param_col.startswith("chla"):
-                return None
-            return os.path.join(
-                MAPS_FOLDER, str(gid), "Chla", "2018_2024", "Permanência_90", "2018_2024_IET90.png"
-            )
+def build_path(gid: int, date: pd.Timestamp, param_col: str, agg_sel: str):
+    spec = MAP_DISPATCH.get((agg_sel, param_col))
+    if spec is None:
+        return None
+    subdirs, fmt = spec
+    folder = os.path.join(MAPS_FOLDER, str(gid), *subdirs)
+    month  = date.strftime("%Y_%m")
+    if fmt is None:
+        return map_months.get((folder, month))
+    name = fmt.format(
+        dstr=date.strftime("%Y%m%d"), month=month, year=date.year, q=(date.month - 1)//3 + 1
+    )
+    return os.path.join(folder, name)
 
-        # Permanência (90 %)
-        return os.path.join(
-            MAPS_FOLDER, str(gid), base, "Anual", "Permanência_90",
-            f"{date.year}_Permanência 90%.png"
-        )
+def clicked_row(clicks, x_vals):
+    """Índice do ponto clicado na figura atual, ou None.
 
-    if clicks and clicks[0]["curveNumber"] == 0:
-        row  = df.iloc[clicks[0]["pointIndex"]]
-        path = build_path(row)
-        if path and os.path.exists(path):
+    Com `key` estável o componente devolve o último clique mesmo depois que a figura
+    muda: descarta pointIndex fora da faixa ou cuja data não confere com a do ponto.
+    """
+    if not clicks or clicks[0]["curveNumber"] != 0:
+        return None
+    idx = clicks[0]["pointIndex"]
+    if not 0 <= idx < len(x_vals):
+        return None
+    cx = clicks[0].get("x")
+    if cx is not None:
+        t = pd.Timestamp(cx, unit="ms") if isinstance(cx, (int, float)) else pd.Timestamp(cx)
+        if t.normalize() != pd.Timestamp(x_vals[idx]).normalize():
+            return None
+    return idx
+
+def render_map(clicks, x_vals, gid_arr, param_col: str, agg_sel: str):
+    idx = clicked_row(clicks, x_vals)
+    if idx is not None:
+        gid  = int(gid_arr[idx])
+        path = build_path(gid, pd.Timestamp(x_vals[idx]), param_col, agg_sel)
+        img  = None
+        if path in map_paths:
+            try:
+                img = read_png(path, os.path.getmtime(path))
+            except OSError:   # índice de até 1 h: o PNG pode ter sido removido desde a varredura
+                pass
+        if img is not None:
             st.markdown('<div class="map-container">', unsafe_allow_html=True)
-            st.image(path, use_container_width=True)
+            st.image(img, width=CONFIG["map_width"])
             st.markdown('</div>', unsafe_allow_html=True)
             st.markdown(
-                f"<div style='text-align:center;font-size:0.8em;color:gray;'>GID: {int(row['gid'])}</div>",
+                f"<div style='text-align:center;font-size:0.8em;color:gray;'>GID: {gid}</div>",
                 unsafe_allow_html=True,
             )
         else:
@@ -265,3 +438,79 @@ with right:
             "<div style='text-align:center;margin-top:20px;'>Clique em um ponto do gráfico para ver o mapa aqui.</div>",
             unsafe_allow_html=True,
         )
+
+@st.fragment
+def chart_and_map(fig, x_vals, gid_arr, param_col: str, agg_sel: str, key: str):
+    """Gráfico + mapa do ponto clicado; um clique reexecuta só este fragmento.
+
+    O mapa é escrito em `map_slot` (st.empty da coluna direita), substituído a cada rerun.
+    `key` fixa a identidade do componente: sem ela o id vem do JSON da figura e cada
+    mudança remonta o plotly (perdendo zoom/uirevision).
+    """
+    st.markdown('<div style="width:100%;">', unsafe_allow_html=True)
+    clicks = plotly_events(
+        fig, click_event=True, hover_event=False, select_event=False,
+        override_height=CONFIG["events_height"], key=key,
+    )
+    st.markdown("</div>", unsafe_allow_html=True)
+
+    with map_slot.container():
+        render_map(clicks, x_vals, gid_arr, param_col, agg_sel)
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Layout
+# ──────────────────────────────────────────────────────────────────────────────
+left, right = st.columns(CONFIG["col_ratio"], gap="small")
+map_slot    = right.empty()
+
+with left:
+    # 1) Massa d’água
+    sel_mass = st.selectbox("Selecione a massa d'água:", masses, index=def_idx)
+
+    # 2) Parâmetro
+    param_opts = {"Clorofila-a": "chla_mean", "Turbidez": "turb_mean"}
+    param_lab  = st.radio("Selecione o parâmetro:", list(param_opts.keys()))
+    param_col  = param_opts[param_lab]
+
+    # 3) Estatística
+    stat_opts = {"Média": "mean", "Mediana": "median"}
+    stat_lab  = st.radio("Estatística mostrada no gráfico:", list(stat_opts.keys()), horizontal=True)
+    stat_key  = stat_opts[stat_lab]
+
+    # 4) Intervalo de datas
+    d_range = st.slider("Selecione o intervalo de datas:", dmin, dmax, (dmin, dmax), format="YYYY-MM-DD")
+
+    # 5) Nível de agregação (mapas)
+    agg_sel = st.radio("Selecione o nível de agregação do mapa:", CONFIG["agg_opts"], horizontal=True)
+
+    # ─── Filtra dados ─────────────────────────────────────────────────────────
+    cnt_col   = resolve_stat_col(param_col, "count")
+    low_count = False
+    if cnt_col in gdf.columns:
+        low_count = st.checkbox("Filtrar pontos com baixa contagem de pixels", value=False)
+
+    df, thr = filter_df(sel_mass, param_col, d_range[0], d_range[1], low_count)
+    if low_count:
+        st.caption(f"Pontos com contagem &lt; **{int(thr)}** pixels removidos.")
+
+    if df.empty:
+        st.warning("Nenhum dado disponível para essa combinação.")
+        st.stop()
+
+    # ─── Pontos desenhados (pointIndex do clique → linha de pts) ─────────────
+    pts     = plot_rows(sel_mass, param_col, stat_key, d_range[0], d_range[1], low_count)
+    x_vals  = pts["date_key"].to_numpy()
+    gid_arr = pts["gid"].to_numpy()
+
+    # ─── Média móvel – 30 dias ───────────────────────────────────────────────
+    show_roll = st.checkbox("Adicionar linha de média móvel (30 dias)", value=False)
+
+    # ─── Gráfico ─────────────────────────────────────────────────────────────
+    # JSON em cache – sem revalidar/serializar um go.Figure a cada rerun
+    fig = FigJSON(
+        make_fig(sel_mass, param_col, stat_key, d_range[0], d_range[1], low_count, show_roll)
+    )
+
+    # mesma chave que o uirevision da figura: troca de massa/parâmetro remonta o gráfico
+    chart_and_map(fig, x_vals, gid_arr, param_col, agg_sel, key=f"{sel_mass}|{param_col}")
+
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Conversão única de all_water_masses.pkl → all_water_masses.parquet
+  • Mantém só as colunas usadas pelo dashboard (sem geometria)
+  • date_key gravado como datetime64 no schema do Parquet
+
+Uso: python pkl_to_parquet.py
+"""
+
+import os, pickle, pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PKL_PATH = os.path.join(BASE_DIR, "all_water_masses.pkl")
+PQ_PATH  = os.path.join(BASE_DIR, "all_water_masses.parquet")
+
+COLUMNS = [
+    "nmoriginal", "date_key", "gid",
+    "chla_mean", "chla_media", "chla_count",
+    "turb_mean", "turb_media", "turb_count",
+]
+
+if __name__ == "__main__":
+    with open(PKL_PATH, "rb") as f:
+        gdf = pickle.load(f)
+
+    df = pd.DataFrame(gdf[COLUMNS])
+    df["date_key"] = pd.to_datetime(df["date_key"], errors="coerce")
+    df.to_parquet(PQ_PATH, compression="zstd", index=False)
+    print(f"{len(df)} linhas gravadas em {PQ_PATH}")